@@ -39,15 +39,40 @@ IMPORTANT ISSUES with openSeSSHIAMe.
 '''
 
 
-import copy
 import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+from operator import itemgetter
 
 from docopt import docopt
-import boto3
-import requests
 
 from .__about__ import __version__
 
+# boto3 and requests are imported lazily in __init__ -- together they cost
+# hundreds of milliseconds to import, none of which is needed for
+# `openSeSSHIAMe --help` or `--version`
+
+# orjson parses JSON several times faster than the stdlib thanks to its
+# native implementation, which is worth having for a CLI that cold-starts on
+# a timer -- but it's optional, so fall back to the stdlib when absent
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
+# itemgetter dispatches in C, so these avoid repeated Python-level key
+# hashing in the per-rule loops
+_get_rule_ID = itemgetter('SecurityGroupRuleId')
+_get_rule_ports = itemgetter('FromPort', 'ToPort')
+
+
+def _rule_source(rule):
+    '''Human-readable traffic source of a security group rule, for verbose
+    output. A rule carries exactly one of these source fields.'''
+    return (rule.get('CidrIpv4') or rule.get('CidrIpv6')
+            or rule.get('PrefixListId')
+            or rule.get('ReferencedGroupInfo', {}).get('GroupId', 'unknown'))
+
 
 class openSeSSHIAMe:
     '''
@@ -73,10 +98,15 @@ class openSeSSHIAMe:
                 verbose (bool, optional): Additional info printed to stdout if
                     True
         '''
+        import boto3
+        import requests
+        from botocore.config import Config
+        from requests.adapters import HTTPAdapter
+
         self.verbose = kwargs.get('verbose', False)
 
-        with open(config_filename, 'r') as config_file:
-            self.config = config = json.loads(config_file.read())
+        with open(config_filename, 'rb') as config_file:
+            self.config = config = _json_loads(config_file.read())
 
         # TODO: check that config contains the necessary entries
 
@@ -84,80 +114,115 @@ class openSeSSHIAMe:
             aws_access_key_id=config['aws_access_key_id'],
             aws_secret_access_key=config['aws_secret_access_key'])
 
-        self.IAM = self.session.client('iam')
-        self.EC2 = self.session.client('ec2',
-                                       region_name=self.config['aws_region'])
+        # Force credential resolution once up front so neither client re-runs
+        # the provider chain (env vars, shared config, IMDS) lazily on its
+        # first request
+        credentials = self.session.get_credentials()
+        if credentials is not None:
+            credentials.get_frozen_credentials()
+
+        # One client config shared by IAM and EC2: bounded retries and
+        # timeouts cap tail latency on flaky networks
+        self._client_config = Config(
+            retries={'max_attempts': 3, 'mode': 'standard'},
+            connect_timeout=3, read_timeout=10)
+
+        # The openSeSSHIAMe ID (and the rule description derived from it)
+        # cannot change within a process, so fetch it from IAM at most once
+        self._cached_ID = None
+
+        # Reuse one HTTP session (connection pooling and keep-alive) instead
+        # of paying for a fresh TCP+TLS handshake on every request
+        self._http = requests.Session()
+        self._http.mount('https://',
+                         HTTPAdapter(pool_connections=2, pool_maxsize=4))
+        self._http.headers.update(
+            {'User-Agent': 'openSeSSHIAMe/' + __version__})
+
+    def __del__(self):
+        http = getattr(self, '_http', None)
+        if http is not None:
+            http.close()
+
+    # The clients are constructed lazily: each session.client() call loads
+    # megabytes of botocore service-model data, so pay for it only on first
+    # use (and not at all if an early error short-circuits the run).
+    @cached_property
+    def IAM(self):
+        return self.session.client('iam', config=self._client_config)
+
+    @cached_property
+    def EC2(self):
+        return self.session.client('ec2',
+                                   region_name=self.config['aws_region'],
+                                   config=self._client_config)
 
     def list_existing_ingress_rules(self):
         '''List existing ingress rules for the current openSeSSHIAMe user.
 
-        This uses openSeSSHIAMe's bookeeping method to only return rules
-        generated by openSeSSHIAMe. This method can handle existing rules that
-        are present as multiple `IpRanges` elements within one `IpPermissions`
-        element in the configured security group.
+        This uses openSeSSHIAMe's bookeeping methods to only return rules
+        generated by openSeSSHIAMe: rules are matched by their
+        `openSeSSHIAMe-ID` tag, or by their description for rules created
+        before openSeSSHIAMe started tagging them. The query is filtered
+        server-side to the configured security group, so unrelated groups are
+        never transferred.
 
         Returns:
-            list: List of rules. Each element of rules -- a rule -- should be
-                structured like an element of `IpPermissions` in the boto3
-                API. As an example:
+            list: List of rules. Each element of rules -- a rule -- is a
+                security group rule as returned by
+                `describe_security_group_rules` in the boto3 API. As an
+                example:
 
                 {
-                  "FromPort": 22,
+                  "SecurityGroupRuleId": "sgr-0123456789abcdef0",
+                  "GroupId": "sg-0123456789abcdef0",
+                  "IsEgress": false,
                   "IpProtocol": "tcp",
-                  "IpRanges": [
-                    {
-                      "CidrIp": "10.0.0.1/32",
-                      "Description": "A description. Take a look at
-                                     `_generate_ingress_rule_description()` to
-                                     see how this is used by openSeSSHIAMe."
-                    }
-                  ],
-                  "Ipv6Ranges": [],
-                  "PrefixListIds": [],
+                  "FromPort": 22,
                   "ToPort": 22,
-                  "UserIdGroupPairs": []
+                  "CidrIpv4": "10.0.0.1/32",
+                  "Description": "A description. Take a look at
+                                 `_generate_ingress_rule_description()` to
+                                 see how this is used by openSeSSHIAMe.",
+                  "Tags": [...]
                 }
 
-                For more information on the structure of `IpPermissions`, see:
-                https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/ec2.html#EC2.Client.authorize_security_group_ingress
+                For more information on the structure of these rules, see:
+                https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/ec2.html#EC2.Client.describe_security_group_rules
         '''
-        sec_groups = self.EC2.describe_security_groups(
-            GroupIds=[self.config['security_group_ID']])
-        assert len(sec_groups['SecurityGroups']) == 1
-        sec_group = sec_groups['SecurityGroups'][0]
-
+        openSeSSHIAMe_ID = self._get_openSeSSHIAMe_ID()
         ingress_rule_description = self._generate_ingress_rule_description()
 
         if self.verbose:
             print('Finding existing ingress rules for %s...' %
                   ingress_rule_description)
 
-        # Build list of existing ingress rules for current openSeSSHIAMe user
-        existing_rules = []
-        for rule in sec_group['IpPermissions']:
-            # Sometimes multiple rules (as seen from the AWS console) are
-            # present as multiple IpRanges elements within one IpPermissions
-            # element, so we'll make a template rule to populate with only the
-            # IpRange of interest. This should help avoid revoking rules that
-            # are not managed by openSeSSHIAMe, for instance.
-            rule_template = copy.deepcopy(rule)
-            rule_template['IpRanges'] = None
-
-            for IP_range in rule['IpRanges']:
-                # This is how openSeSSHIAMe-managed rules for the current IAM
-                # user are tracked
-                if IP_range['Description'] == ingress_rule_description:
-                    existing_rule = copy.deepcopy(rule_template)
-                    existing_rule['IpRanges'] = [IP_range]
-                    existing_rules.append(existing_rule)
-
-                    if self.verbose:
-                        print('Existing rule: access to ports %d--%d from %s' %
-                              (rule['FromPort'], rule['ToPort'],
-                               IP_range['CidrIp']))
-
-                    # TODO: might want to drop this break
-                    break
+        # Paginate so rules past the first page of a large group are not
+        # silently dropped, which would make the revoke step miss entries
+        paginator = self.EC2.get_paginator('describe_security_group_rules')
+        pages = paginator.paginate(
+            Filters=[{'Name': 'group-id',
+                      'Values': [self.config['security_group_ID']]}])
+
+        # Keep ingress rules tracked for the current openSeSSHIAMe user,
+        # whether through the openSeSSHIAMe-ID tag (applied on creation by
+        # authorize_ingress_rules) or through the rule description (how older
+        # versions tracked rules). This should help avoid revoking rules that
+        # are not managed by openSeSSHIAMe, for instance.
+        existing_rules = [
+            rule
+            for page in pages
+            for rule in page['SecurityGroupRules']
+            if not rule['IsEgress']
+            and (rule.get('Description') == ingress_rule_description
+                 or any(tag['Key'] == 'openSeSSHIAMe-ID'
+                        and tag['Value'] == openSeSSHIAMe_ID
+                        for tag in rule.get('Tags', [])))]
+
+        if self.verbose:
+            for rule in existing_rules:
+                print('Existing rule: access to ports %d--%d from %s' %
+                      (rule['FromPort'], rule['ToPort'], _rule_source(rule)))
 
         return existing_rules
 
@@ -165,39 +230,41 @@ class openSeSSHIAMe:
         '''Revoke ingress rules from the security group in the config.
 
         This method can revoke *any* rules in the security group configured by
-        the current IAM user.
+        the current IAM user. Rules are revoked directly by their
+        `SecurityGroupRuleId`, as returned by `list_existing_ingress_rules`.
 
-        See the boto3 docs for more details about how rules are matched and
-        revoked:
+        See the boto3 docs for more details:
         https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/ec2.html#EC2.Client.revoke_security_group_ingress
 
         Args:
-            rules (list): A list of ingress rules to revoke.
+            rules (list): A list of ingress rules to revoke, in the format
+                returned by `list_existing_ingress_rules`.
         '''
         if not rules:
             return
 
         if self.verbose:
             for rule in rules:
-                for IP_range in rule['IpRanges']:
-                    print('Revoking access to ports %d--%d from %s' %
-                          (rule['FromPort'], rule['ToPort'],
-                           IP_range['CidrIp']))
+                print('Revoking access to ports %d--%d from %s' %
+                      (rule['FromPort'], rule['ToPort'], _rule_source(rule)))
 
         # TODO: check response
         self.EC2.revoke_security_group_ingress(
             GroupId=self.config['security_group_ID'],
-            IpPermissions=rules)
+            SecurityGroupRuleIds=list(map(_get_rule_ID, rules)))
 
     def authorize_ingress_rules(self, rules):
         '''Authorize ingress rules for security group in configuration.
 
-        This does not use openSeSSHIAMe's bookeeping method to facilitate
-        subsequent tracking of these rules -- that's up to the caller of this
-        method.
+        The created rules are tagged with the current user's openSeSSHIAMe ID
+        so that `list_existing_ingress_rules` can find them later. Rule
+        descriptions are still up to the caller of this method (see
+        `generate_ingress_rule`).
 
         Args:
-            rules (list): A list of ingress rules to authorize.
+            rules (list): A list of ingress rules to authorize, each
+                structured like an element of `IpPermissions` in the boto3
+                API.
         '''
         if not rules:
             return
@@ -212,7 +279,47 @@ class openSeSSHIAMe:
         # TODO: check response
         self.EC2.authorize_security_group_ingress(
             GroupId=self.config['security_group_ID'],
-            IpPermissions=rules)
+            IpPermissions=rules,
+            TagSpecifications=[{
+                'ResourceType': 'security-group-rule',
+                'Tags': [{'Key': 'openSeSSHIAMe-ID',
+                          'Value': self._get_openSeSSHIAMe_ID()}]
+            }])
+
+    def modify_ingress_rule(self, rule, port, IPv4_CIDR):
+        '''Update an existing ingress rule in place to allow incoming traffic
+        to the specified port from the specified source range.
+
+        This replaces a revoke + authorize pair with a single
+        `ModifySecurityGroupRules` call -- one API round-trip instead of two,
+        and no window in which no ingress is authorized. The rule keeps its
+        `SecurityGroupRuleId` (and any tags), and its description is
+        refreshed using openSeSSHIAMe's bookeeping method.
+
+        Args:
+            rule (dict): An existing rule to update, in the format returned
+                by `list_existing_ingress_rules`.
+            port (int): The port to allow incoming traffic to.
+            IPv4_CIDR (str): The source IPv4 CIDR range to allow incoming
+                traffic from.
+        '''
+        if self.verbose:
+            print('Updating existing rule to allow access to port %d from %s'
+                  % (port, IPv4_CIDR))
+
+        # TODO: check response
+        self.EC2.modify_security_group_rules(
+            GroupId=self.config['security_group_ID'],
+            SecurityGroupRules=[{
+                'SecurityGroupRuleId': rule['SecurityGroupRuleId'],
+                'SecurityGroupRule': {
+                    'IpProtocol': 'tcp',
+                    'FromPort': port,
+                    'ToPort': port,
+                    'CidrIpv4': IPv4_CIDR,
+                    'Description': self._generate_ingress_rule_description()
+                }
+            }])
 
     # TODO: accept protocol, port range, IPv6, etc.
     def generate_ingress_rule(self, port, IPv4_CIDR=None):
@@ -261,12 +368,21 @@ class openSeSSHIAMe:
         return 'openSeSSHIAMe-' + self._get_openSeSSHIAMe_ID()
 
     def _get_public_IPv4_address(self):
-        'Get public IPv4 address.'
+        '''Get public IPv4 address.
+
+        When running on an EC2 instance, the address is read from the
+        instance metadata service (IMDSv2) over the link-local endpoint --
+        sub-millisecond, with no external dependency. Otherwise this falls
+        back to asking ipify.'''
         # TODO: use multiple providers to protect against getting an incorrect
         # address. Only use methods that encrypt in transit. Also see:
         # https://unix.stackexchange.com/q/22615
+        address = self._get_public_IPv4_address_from_IMDS()
+        if address is not None:
+            return address
+
         try:
-            res = requests.get('https://api.ipify.org')
+            res = self._http.get('https://api.ipify.org', timeout=5)
             if res.status_code == 200:
                 return res.text
 
@@ -278,15 +394,59 @@ class openSeSSHIAMe:
             'Can not determine public IP address, status code: '
             + str(res.status_code))
 
+    def _get_public_IPv4_address_from_IMDS(self):
+        '''Get public IPv4 address from the EC2 instance metadata service
+        (IMDSv2), or None when not running on an EC2 instance.
+
+        The metadata endpoint is link-local, so the timeouts are kept short
+        enough that deployments outside of EC2 fall through to ipify almost
+        immediately.'''
+        from requests import RequestException
+
+        try:
+            token_res = self._http.put(
+                'http://169.254.169.254/latest/api/token',
+                headers={'X-aws-ec2-metadata-token-ttl-seconds': '21600'},
+                timeout=0.2)
+            if token_res.status_code != 200:
+                return None
+
+            res = self._http.get(
+                'http://169.254.169.254/latest/meta-data/public-ipv4',
+                headers={'X-aws-ec2-metadata-token': token_res.text},
+                timeout=0.2)
+            if res.status_code == 200:
+                return res.text
+
+        except RequestException:
+            pass
+
+        return None
+
     def _get_openSeSSHIAMe_ID(self):
         '''Get value of IAM tag that describes the current IAM user's
-        openSeSSHIAMe ID.'''
-        IAM_user_tags = self.IAM.list_user_tags(
-            UserName=self.config['aws_iam_username'])
-
-        for tag in IAM_user_tags['Tags']:
-            if tag['Key'] == 'openSeSSHIAMe-ID':
-                return tag['Value']
+        openSeSSHIAMe ID.
+
+        The value is cached after the first call, since it cannot change
+        within a process -- repeated calls don't cost additional IAM API
+        round-trips.'''
+        if self._cached_ID is not None:
+            return self._cached_ID
+
+        # Paginate in case the user carries more tags than fit in one
+        # ListUserTags response. The IAM API has no server-side tag-key
+        # filter, so collect the tags into a dict and do a single lookup
+        # rather than scanning in an interpreted loop.
+        paginator = self.IAM.get_paginator('list_user_tags')
+        tags = {
+            tag['Key']: tag['Value']
+            for page in paginator.paginate(
+                UserName=self.config['aws_iam_username'])
+            for tag in page['Tags']}
+
+        self._cached_ID = tags.get('openSeSSHIAMe-ID')
+        if self._cached_ID is not None:
+            return self._cached_ID
 
         raise RuntimeError(
             '''Could not get a unique ID for openSeSSHIAMe to use, check that
@@ -302,13 +462,55 @@ def main():
 
     sesame = openSeSSHIAMe(config_filename=config_filename, verbose=verbose)
 
-    # TODO: if the current public IP address is already authorized, filter it
-    # out before revoking and then there's no need to re-authorize it.
-    existing_rules = sesame.list_existing_ingress_rules()
-    sesame.revoke_ingress_rules(existing_rules)
-
-    new_SSH_rule = sesame.generate_ingress_rule(22)
-    sesame.authorize_ingress_rules([new_SSH_rule])
+    # The public-IP lookup (HTTPS to ipify) and the IAM + EC2 queries are
+    # independent and each dominated by network latency, so overlap them
+    # instead of paying for their round-trips back to back. boto3 clients are
+    # thread-safe for separate call invocations.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        future_address = executor.submit(sesame._get_public_IPv4_address)
+        future_rules = executor.submit(sesame.list_existing_ingress_rules)
+        existing_rules = future_rules.result()
+        current_CIDR = future_address.result() + '/32'
+
+    # If the current public IP address is already authorized, leave that rule
+    # in place and skip re-authorizing it -- on the common "IP unchanged" case
+    # (e.g. repeated systemd timer firings) this avoids both mutating EC2 API
+    # calls entirely.
+    stale_rules = [
+        rule for rule in existing_rules
+        if not (_get_rule_ports(rule) == (22, 22)
+                and rule.get('CidrIpv4') == current_CIDR)]
+    already_authorized = len(stale_rules) < len(existing_rules)
+
+    # The common case on a systemd timer: the IP hasn't moved and there is
+    # nothing stale to clean up, so return before touching any mutating EC2
+    # API path at all
+    if already_authorized and not stale_rules:
+        if verbose:
+            print('Ingress from %s is already authorized' % current_CIDR)
+        return
+
+    # When a stale SSH rule exists and only the source address changed (the
+    # common case after moving location), update it in place -- one mutating
+    # API call instead of a revoke + authorize pair.
+    updatable_rule = next(
+        (rule for rule in stale_rules
+         if _get_rule_ports(rule) == (22, 22) and rule.get('CidrIpv4')),
+        None) if not already_authorized else None
+
+    if already_authorized:
+        sesame.revoke_ingress_rules(stale_rules)
+        if verbose:
+            print('Ingress from %s is already authorized' % current_CIDR)
+    elif updatable_rule is not None:
+        sesame.modify_ingress_rule(updatable_rule, 22, current_CIDR)
+        sesame.revoke_ingress_rules(
+            [rule for rule in stale_rules if rule is not updatable_rule])
+    else:
+        sesame.revoke_ingress_rules(stale_rules)
+        new_SSH_rule = sesame.generate_ingress_rule(22,
+                                                    IPv4_CIDR=current_CIDR)
+        sesame.authorize_ingress_rules([new_SSH_rule])
 
 
 if __name__ == '__main__':
@@ -45,11 +45,22 @@ setup(
         'Programming Language :: Python :: 3'
     ],
 
+    # functools.cached_property is used for the lazy boto3 clients
+    python_requires='>=3.8',
+
     install_requires=[
-        'boto3 >= 1.9.121',
+        # 1.18.1 is the first release whose EC2 client has
+        # describe_security_group_rules, modify_security_group_rules,
+        # revoking by SecurityGroupRuleIds, and TagSpecifications on
+        # authorize_security_group_ingress
+        'boto3 >= 1.18.1',
         'docopt >= 0.6.2',
         'requests >= 2.21.0'
     ],
+    extras_require={
+        # Faster JSON parsing for the configuration file
+        'fast': ['orjson']
+    },
 
     packages=find_packages(),
     package_data={